@@ -4,12 +4,59 @@
 Created 20211213
 Updated 20230824 - updated several method and variable names
                    updated to use either netCDF4 or xarray Dataset
+Updated 20261014 - vectorized ll2ij, cached projections/transformers,
+                   raise ValueError on bad input, added CMAQLocator
 
 @author: Nash Skipper
 """
 
 import numpy as np
 import cartopy.crs as ccrs
+from pyproj import Transformer
+
+# numba is optional; used by ll2ij for large numbers of points
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# lon-lat coordinate reference system shared by all instances
+_PC = ccrs.PlateCarree()
+
+# CMAQ (IOAPI) grid types supported by cmaqfile
+_SUPPORTED_GDTYP = {
+    2: 'Lambert Conformal Conic',
+    6: 'North Polar Stereographic',
+}
+
+# minimum number of points for ll2ij to use the numba kernel
+# (below this, compile/dispatch time outweighs the savings)
+_NUMBA_MIN_POINTS = 100000
+
+
+if njit is not None:
+    @njit(parallel=True)
+    def _ll2ij_kernel(xpts, ypts, xorig, yorig, xcell, ycell, ncols, nrows,
+                      out_i, out_j):
+        
+        """
+        Fill out_i, out_j with the grid indices of 1D arrays of X, Y points
+        in a single pass. NaN if outside the domain.
+        """
+        
+        for k in prange(xpts.size):
+            fi = (xpts[k] - xorig)/xcell
+            fj = (ypts[k] - yorig)/ycell
+            # comparisons are False for NaN, so bad points are outside too
+            if fi >= 0 and fi <= ncols and fj >= 0 and fj <= nrows:
+                # points on the east/north edge belong to the last cell
+                out_i[k] = min(int(fi), ncols - 1)
+                out_j[k] = min(int(fj), nrows - 1)
+            else:
+                out_i[k] = np.nan
+                out_j[k] = np.nan
+else:
+    _ll2ij_kernel = None
 
 
 class cmaqfile(object):
@@ -23,6 +70,8 @@ class cmaqfile(object):
     Parameters
     ----------
     dataset : xarray or netCDF4 Dataset
+        Must use a supported projection (GDTYP 2 or 6), otherwise
+        ValueError is raised.
 
     Returns
     -------
@@ -33,6 +82,35 @@ class cmaqfile(object):
     
     def __init__(self, dataset):
         self.ds = dataset
+        # projection type checked once here instead of in every method
+        self._gdtyp = int(dataset.GDTYP)
+        if self._gdtyp not in _SUPPORTED_GDTYP:
+            supported = ' and '.join(
+                f'{name} (GDTYP={gdtyp})' for gdtyp, name in _SUPPORTED_GDTYP.items()
+            )
+            raise ValueError(
+                f'Projection GDTYP {self._gdtyp} not supported. '
+                f'Only {supported} projections have been implemented.'
+            )
+        # grid definition read once from file metadata
+        self._xorig = float(dataset.XORIG)
+        self._yorig = float(dataset.YORIG)
+        self._xcell = float(dataset.XCELL)
+        self._ycell = float(dataset.YCELL)
+        self._ncols = int(dataset.NCOLS)
+        self._nrows = int(dataset.NROWS)
+        # domain bounds (outer grid cell corners)
+        self._xmin = self._xorig
+        self._xmax = self._xorig + self._xcell*self._ncols
+        self._ymin = self._yorig
+        self._ymax = self._yorig + self._ycell*self._nrows
+        # projections built by getCMAQproj, keyed by earth radius
+        self._proj = {}
+        # pyproj transformers built by _get_transformers, keyed by earth radius
+        self._transformers = {}
+        # 1D grid axes built by getXYcenters and getXYcorners
+        self._XYcenters = None
+        self._XYcorners = None
     
     
     def getXYcenters(self):
@@ -49,29 +127,30 @@ class cmaqfile(object):
 
         """
         
-        if self.ds.GDTYP==1:
-            print('ERROR: Cannot use getXYcenters with lat-lon projection.')
-            return
-        
-        xcell = self.ds.XCELL
-        xstart = self.ds.XORIG
-        xend = xstart + xcell*self.ds.NCOLS
-        ycell = self.ds.YCELL
-        ystart = self.ds.YORIG
-        yend = ystart + ycell*self.ds.NROWS
-        
-        # grid cell centers
-        X = np.arange(xstart+xcell/2., xend, xcell)
-        Y = np.arange(ystart+ycell/2., yend, ycell)
+        if self._XYcenters is None:
+            # grid cell centers, built from the cell count so the number
+            # of points is exact
+            X = self._xorig + (np.arange(self._ncols, dtype=np.float64) + 0.5)*self._xcell
+            Y = self._yorig + (np.arange(self._nrows, dtype=np.float64) + 0.5)*self._ycell
+            # cached arrays are shared between calls
+            X.flags.writeable = False
+            Y.flags.writeable = False
+            self._XYcenters = (X, Y)
         
-        return X, Y
+        return self._XYcenters
     
     
-    def getXYcorners(self):
+    def getXYcorners(self, sparse=False):
 
         """
         Get X and Y grid cell corners (in m) from CMAQ file metadata.
 
+        Parameters
+        ----------
+        sparse : bool, optional
+            If True, return broadcastable arrays of shape (1, NCOLS+1) and
+            (NROWS+1, 1) instead of full 2D grids. The default is False.
+
         Returns
         -------
         Xcorners : ndarray of float
@@ -81,21 +160,18 @@ class cmaqfile(object):
     
         """
         
-        if self.ds.GDTYP==1:
-            print('ERROR: Cannot use getXYcorners with lat-lon projection.')
-            return
+        if self._XYcorners is None:
+            # grid cell corners, built from the cell count so the number
+            # of points is exact
+            X = self._xorig + np.arange(self._ncols+1, dtype=np.float64)*self._xcell
+            Y = self._yorig + np.arange(self._nrows+1, dtype=np.float64)*self._ycell
+            # cached arrays are shared between calls
+            X.flags.writeable = False
+            Y.flags.writeable = False
+            self._XYcorners = (X, Y)
         
-        xcell = self.ds.XCELL
-        xstart = self.ds.XORIG
-        xend = xstart + xcell*self.ds.NCOLS
-        ycell = self.ds.YCELL
-        ystart = self.ds.YORIG
-        yend = ystart + ycell*self.ds.NROWS
-        
-        # grid cell corners
-        X = np.arange(xstart, xend+xcell, xcell)
-        Y = np.arange(ystart, yend+ycell, ycell)
-        Xcorners, Ycorners = np.meshgrid(X, Y)
+        X, Y = self._XYcorners
+        Xcorners, Ycorners = np.meshgrid(X, Y, sparse=sparse)
         
         return Xcorners, Ycorners
     
@@ -119,8 +195,12 @@ class cmaqfile(object):
     
         """
         
+        # reuse projection if already built for this radius
+        if radius in self._proj:
+            return self._proj[radius]
+        
         # Lambert conformal conic
-        if self.ds.GDTYP==2:
+        if self._gdtyp==2:
             centlon = self.ds.XCENT
             centlat = self.ds.YCENT
             stdpar = (self.ds.P_ALP, self.ds.P_BET)
@@ -136,7 +216,8 @@ class cmaqfile(object):
                 globe=cmaqglobe
             )
         # north polar stereographic
-        elif self.ds.GDTYP==6:
+        # (GDTYP checked in __init__, so the only other case)
+        else:
             centlon = self.ds.XCENT
             lat_true_scale = self.ds.P_BET
             cmaqglobe = ccrs.Globe(
@@ -149,21 +230,41 @@ class cmaqfile(object):
                 true_scale_latitude=lat_true_scale,
                 globe=cmaqglobe
             )
-        # other projections not implemented
-        else:
-            print(
-                f'''
-                Projection GDTYP {self.ds.GDTYP} not supported.
-                Only Lambert Conformal Conic (GDTYP=2) and 
-                North Polar Stereogrpahic (GDTYP=6) projections
-                have been implemented.
-                '''
-            )
-            return
+        
+        self._proj[radius] = projection
         
         return projection
     
     
+    def _get_transformers(self, radius=6370000.):
+        
+        """
+        Get pyproj transformers between lon-lat and the CMAQ projection.
+        Built once per radius and reused.
+        
+        Parameters
+        ----------
+        radius : float, optional
+            Assumed radius (in m) of the earth. The default is 6370000.
+        
+        Returns
+        -------
+        fwd : pyproj Transformer
+            Lon-lat to CMAQ projection X, Y.
+        inv : pyproj Transformer
+            CMAQ projection X, Y to lon-lat.
+        
+        """
+        
+        if radius not in self._transformers:
+            cmaqproj = self.getCMAQproj(radius=radius)
+            fwd = Transformer.from_crs(_PC, cmaqproj, always_xy=True)
+            inv = Transformer.from_crs(cmaqproj, _PC, always_xy=True)
+            self._transformers[radius] = (fwd, inv)
+        
+        return self._transformers[radius]
+    
+    
     def ll2xy(self, lons, lats):
 
         """
@@ -171,32 +272,29 @@ class cmaqfile(object):
 
         Parameters
         ----------
-        lons : float OR iterable of float
+        lons : float OR array_like of float
             Longitudes to be transformed.
-        lats : float OR iterable of float
-            Latitudes to be transformed.
+        lats : float OR array_like of float
+            Latitudes to be transformed. Same number of points as lons.
 
         Returns
         -------
-        xpts : list of float
-            Coordinates of west-east dimension (X).
-        ypts : list of float
-            Coordinates of south-north dimension (Y).
+        xpts : ndarray of float
+            Coordinates of west-east dimension (X). Same shape as lons.
+        ypts : ndarray of float
+            Coordinates of south-north dimension (Y). Same shape as lons.
 
         """
         
-        if self.ds.GDTYP==1:
-            print('ERROR: GDTYPE=1. Cannot use ll2xy with lat-lon projection.')
-            return
-        
-        lons = np.asarray(lons)
-        lats = np.asarray(lats)
+        lons = np.ascontiguousarray(lons, dtype=np.float64)
+        lats = np.ascontiguousarray(lats, dtype=np.float64)
         if lons.size != lats.size:
-            print('ERROR: Number of longitude and latitude points must be equal.')
-            return
+            raise ValueError('Number of longitude and latitude points must be equal.')
+        lats = lats.reshape(lons.shape)
         
-        cmaqproj = self.getCMAQproj()
-        xpts, ypts, _ = cmaqproj.transform_points(ccrs.PlateCarree(), lons, lats).T
+        # transform all points in one call (output has the input shape)
+        fwd, _ = self._get_transformers()
+        xpts, ypts = fwd.transform(lons, lats)
         
         return xpts, ypts
     
@@ -208,81 +306,209 @@ class cmaqfile(object):
 
         Parameters
         ----------
-        X : float OR iterable of float
-            Longitudes to be transformed.
-        Y : float OR iterable of float
-            Latitudes to be transformed.
+        X : float OR array_like of float
+            X coordinates to be transformed.
+        Y : float OR array_like of float
+            Y coordinates to be transformed. Same number of points as X.
 
         Returns
         -------
-        lonpts : list of float
-            Longitude coordinates.
-        latpts : list of float
-            Latitude coordinates.
+        lonpts : ndarray of float
+            Longitude coordinates. Same shape as X.
+        latpts : ndarray of float
+            Latitude coordinates. Same shape as X.
 
         """
         
-        if self.ds.GDTYP==1:
-            print('ERROR: Cannot use ll2xy with lat-lon projection.')
-            return
-        
-        X = np.asarray(X)
-        Y = np.asarray(Y)
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        Y = np.ascontiguousarray(Y, dtype=np.float64)
         if X.size != Y.size:
-            print('ERROR: Number of X and Y points must be equal.')
-            return
+            raise ValueError('Number of X and Y points must be equal.')
+        Y = Y.reshape(X.shape)
         
-        cmaqproj = self.getCMAQproj()
-        lonpts, latpts, _ = ccrs.PlateCarree().transform_points(cmaqproj, X, Y).T
+        # transform all points in one call (output has the input shape)
+        _, inv = self._get_transformers()
+        lonpts, latpts = inv.transform(X, Y)
         
         return lonpts, latpts
     
     
-    def ll2ij(self, lons, lats):
+    def ll2ij(self, lons, lats, dtype=np.float64):
 
         """
         Get the indices of longitude, latitude points.
 
         Parameters
         ----------
-        lons : float OR iterable of float
+        lons : float OR array_like of float
             Longitudes to be transformed.
-        lats : float OR iterable of float
-            Latitudes to be transformed.
+        lats : float OR array_like of float
+            Latitudes to be transformed. Same number of points as lons.
+        dtype : numpy float dtype, optional
+            Precision (np.float64 or np.float32) of the index calculation
+            and of the returned indices. np.float32 halves memory use for
+            large numbers of points and still gives exact cell indices for
+            CMAQ-sized grids. The default is np.float64.
 
         Returns
         -------
-        i : list of int
+        i : ndarray of float
             Indices of west-east dimension. NaN if outside the domain.
-        j : list of int
+            Same shape as lons.
+        j : ndarray of float
             Indices of south-north dimension. NaN if outside the domain.
+            Same shape as lons.
 
         """
         
-        if self.ds.GDTYP==1:
-            print('ERROR: Cannot use ll2ij with lat-lon projection.')
-            return
+        # locator reuses this instance's cached transformer and grid
+        return CMAQLocator(self)(lons, lats, dtype=dtype)
+
+
+class CMAQLocator(object):
+    
+    """
+    Reusable lookup of CMAQ grid indices for longitude, latitude points.
+    Holds the lon-lat to X, Y transformer and the grid definition, so
+    repeated queries on the same grid do no setup work.
+
+    Parameters
+    ----------
+    cmaq : cmaqfile OR xarray or netCDF4 Dataset
+        CMAQ file (or its Dataset) defining the grid.
+    radius : float, optional
+        Assumed radius (in m) of the earth. The default is 6370000.
+
+    Returns
+    -------
+    locator : CMAQLocator
+        Callable returning (i, j) for longitude, latitude points.
+    """
+    
+    
+    def __init__(self, cmaq, radius=6370000.):
+        if not isinstance(cmaq, cmaqfile):
+            cmaq = cmaqfile(cmaq)
+        self._fwd, _ = cmaq._get_transformers(radius=radius)
+        self._xcell = cmaq._xcell
+        self._ycell = cmaq._ycell
+        self._ncols = cmaq._ncols
+        self._nrows = cmaq._nrows
+        self._xmin = cmaq._xmin
+        self._xmax = cmaq._xmax
+        self._ymin = cmaq._ymin
+        self._ymax = cmaq._ymax
+    
+    
+    def __call__(self, lons, lats, dtype=np.float64):
+
+        """
+        Get the indices of longitude, latitude points.
+
+        Parameters
+        ----------
+        lons : float OR array_like of float
+            Longitudes to be transformed.
+        lats : float OR array_like of float
+            Latitudes to be transformed. Same number of points as lons.
+        dtype : numpy float dtype, optional
+            Precision (np.float64 or np.float32) of the index calculation
+            and of the returned indices. The default is np.float64.
+
+        Returns
+        -------
+        i : ndarray of float
+            Indices of west-east dimension. NaN if outside the domain.
+            Same shape as lons.
+        j : ndarray of float
+            Indices of south-north dimension. NaN if outside the domain.
+            Same shape as lons.
+
+        """
         
-        lons = np.asarray(lons)
-        lats = np.asarray(lats)
+        lons = np.ascontiguousarray(lons, dtype=np.float64)
+        lats = np.ascontiguousarray(lats, dtype=np.float64)
         if lons.size != lats.size:
-            print('ERROR: Number of longitude and latitude points must be equal.')
-            return
-        
-        Xcenters, Ycenters = self.getXYcenters()
-        Xcorners, Ycorners = self.getXYcorners()
-        xpts, ypts = self.ll2xy(lons, lats)
-        
-        i=[]
-        j=[]
-        for x, y in zip(xpts, ypts):
-            if x < Xcorners.min() or x > Xcorners.max(): # outside the domain
-                i.append(np.nan)
-                j.append(np.nan)
-            elif y < Ycorners.min() or y > Ycorners.max(): # outside the domain
-                i.append(np.nan)
-                j.append(np.nan)
-            else:
-                i.append(np.argmin(np.abs(Xcenters-x)))
-                j.append(np.argmin(np.abs(Ycenters-y)))
+            raise ValueError('Number of longitude and latitude points must be equal.')
+        lats = lats.reshape(lons.shape)
+        
+        xpts, ypts = self._fwd.transform(lons, lats)
+        
+        # xy2ij checks dtype
+        return self.xy2ij(xpts, ypts, dtype=dtype)
+    
+    
+    def xy2ij(self, xpts, ypts, dtype=np.float64):
+        
+        """
+        Get the indices of X, Y points on the (uniform) CMAQ grid.
+        
+        Parameters
+        ----------
+        xpts : float OR array_like of float
+            Coordinates of west-east dimension (X) in m.
+        ypts : float OR array_like of float
+            Coordinates of south-north dimension (Y) in m. Same number of
+            points as xpts.
+        dtype : numpy float dtype, optional
+            Precision (np.float64 or np.float32) of the calculation and of
+            the returned indices. The default is np.float64.
+        
+        Returns
+        -------
+        i : ndarray of float
+            Indices of west-east dimension. NaN if outside the domain.
+            Same shape as xpts.
+        j : ndarray of float
+            Indices of south-north dimension. NaN if outside the domain.
+            Same shape as xpts.
+        
+        """
+        
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError('dtype must be np.float32 or np.float64.')
+        
+        # projected points are float64; cast once to working precision
+        dtype = np.dtype(dtype).type
+        xpts = np.ascontiguousarray(xpts, dtype=dtype)
+        ypts = np.ascontiguousarray(ypts, dtype=dtype)
+        if xpts.size != ypts.size:
+            raise ValueError('Number of X and Y points must be equal.')
+        ypts = ypts.reshape(xpts.shape)
+        xmin = dtype(self._xmin)
+        xmax = dtype(self._xmax)
+        ymin = dtype(self._ymin)
+        ymax = dtype(self._ymax)
+        xcell = dtype(self._xcell)
+        ycell = dtype(self._ycell)
+        
+        # fused single pass for large numbers of points
+        if _ll2ij_kernel is not None and xpts.size > _NUMBA_MIN_POINTS:
+            i = np.empty(xpts.shape, dtype=dtype)
+            j = np.empty(xpts.shape, dtype=dtype)
+            _ll2ij_kernel(
+                np.ravel(xpts), np.ravel(ypts),
+                xmin, ymin, xcell, ycell, self._ncols, self._nrows,
+                i.reshape(-1), j.reshape(-1)
+            )
+            return i, j
+        
+        # inside the domain (False for NaN points as well)
+        inside = (xpts >= xmin) & (xpts <= xmax) & (ypts >= ymin) & (ypts <= ymax)
+        
+        # cell index from distance to the grid origin, computed for every
+        # point in place; points on the east/north edge belong to the last cell
+        i = np.empty(xpts.shape, dtype=dtype)
+        j = np.empty(xpts.shape, dtype=dtype)
+        np.subtract(xpts, xmin, out=i)
+        np.subtract(ypts, ymin, out=j)
+        i /= xcell
+        j /= ycell
+        np.floor(i, out=i)
+        np.floor(j, out=j)
+        np.minimum(i, self._ncols - 1, out=i)
+        np.minimum(j, self._nrows - 1, out=j)
+        i[~inside] = np.nan
+        j[~inside] = np.nan
+        
         return i, j